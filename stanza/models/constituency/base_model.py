@@ -25,7 +25,6 @@ import torch
 
 from stanza.models.common import utils
 from stanza.models.constituency import transition_sequence
-# from stanza.models.constituency.parse_transitions import TransitionScheme, CloseConstituent
 from stanza.models.constituency.parse_transitions import TransitionScheme
 from stanza.models.constituency.parse_tree import Tree
 from stanza.models.constituency.state import State
@@ -202,17 +201,20 @@ class BaseModel(ABC):
         # this is the bottom of the TreeStack and will be the same for each State
         transitions = self.initial_transitions()
         constituents = self.initial_constituents()
+        # ROOT starts on the stack.  It is position 0, the sentinel at
+        # the start of the word queue, and has a matching constituent
+        root_constituents = self.push_constituents([constituents] * len(word_queues), [wq[0] for wq in word_queues])
         states = [State(sentence_length=len(wq)-2,   # -2 because it starts and ends with a sentinel
                         num_opens=0,
                         word_queue=wq,
                         gold_tree=None,
                         gold_sequence=None,
                         transitions=transitions,
-                        constituents=constituents,
+                        constituents=root_constituents[idx],
                         word_position=0,
                         score=0.0,
-                        created_arcs=[],
-                        stacks=[]
+                        created_arcs=TreeStack(value=None, parent=None, length=1),
+                        stacks=(0,)
                         )
                   for idx, wq in enumerate(word_queues)]
         if gold_trees:
@@ -471,7 +473,8 @@ class BaseModel(ABC):
 
         new_transitions = self.push_transitions([tree.transitions for tree in state_batch], transitions)
         new_constituents = self.push_constituents(constituents, new_constituents)
-        new_stacks = self.push_constituents(stacks, new_stacks)     # use the constituents's push function as they have the same structure ?
+        # the stacks are plain word positions, so the model doesn't need to see them
+        new_stacks = [stack + (top,) for stack, top in zip(stacks, new_stacks)]
 
         
         state_batch = [state._replace(word_position=word_position,
@@ -503,9 +506,9 @@ class SimpleModel(BaseModel):
     def initial_word_queues(self, tagged_word_lists):
         word_queues = []
         for tagged_words in tagged_word_lists:
-            word_queue =  [None]
-            word_queue += [tag_node for tag_node in tagged_words]
-            word_queue.append(None)
+            # sentinels at both ends, built in one list rather than
+            # copying the words into a temporary list first
+            word_queue = [None, *tagged_words, None]
             if self.reverse_sentence:
                 word_queue.reverse()
             word_queues.append(word_queue)
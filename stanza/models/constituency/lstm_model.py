@@ -44,7 +44,7 @@ from stanza.models.common.vocab import PAD_ID, UNK_ID
 from stanza.models.constituency.base_model import BaseModel
 from stanza.models.constituency.label_attention import LabelAttentionModule
 from stanza.models.constituency.lstm_tree_stack import LSTMTreeStack
-from stanza.models.constituency.parse_transitions import TransitionScheme
+from stanza.models.constituency.parse_transitions import TransitionScheme, legal_mask
 from stanza.models.constituency.parse_tree import Tree
 from stanza.models.constituency.partitioned_transformer import PartitionedTransformerModule
 from stanza.models.constituency.positional_encoding import ConcatSinusoidalEncoding
@@ -1096,11 +1096,12 @@ class LSTMModel(BaseModel, nn.Module):
 
         pred_trans = [self.transitions[pred_max[idx]] for idx in range(len(states))]
         if is_legal:
-            for idx, (state, trans) in enumerate(zip(states, pred_trans)):
-                if not trans.is_legal(state, self):
+            legal = legal_mask(states, self.transitions, self)
+            for idx in range(len(states)):
+                if not legal[idx, pred_max[idx]]:
                     _, indices = predictions[idx, :].sort(descending=True)
-                    for index in indices:
-                        if self.transitions[index].is_legal(state, self):
+                    for index in indices.tolist():
+                        if legal[idx, index]:
                             pred_trans[idx] = self.transitions[index]
                             scores[idx] = predictions[idx, index]
                             break
@@ -1119,8 +1120,9 @@ class LSTMModel(BaseModel, nn.Module):
         predictions = self.forward(states)
         pred_trans = []
         all_scores = []
-        for state, prediction in zip(states, predictions):
-            legal_idx = [idx for idx in range(prediction.shape[0]) if self.transitions[idx].is_legal(state, self)]
+        legal = legal_mask(states, self.transitions, self)
+        for state_idx, prediction in enumerate(predictions):
+            legal_idx = legal[state_idx].nonzero()[0].tolist()
             if len(legal_idx) == 0:
                 pred_trans.append(None)
                 continue
@@ -5,12 +5,17 @@ Also defines a State which holds the various data needed to build
 a parse tree out of tagged words.
 """
 
-from abc import ABC, abstractmethod
-import ast
-from collections import defaultdict
+from abc import ABC, ABCMeta, abstractmethod
 from enum import Enum
 import functools
 import logging
+import warnings
+
+import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from stanza.models.constituency.parse_tree import Tree
 
@@ -64,6 +69,16 @@ class Transition(ABC):
     model is passed in as a dependency injection
     for example, an LSTM model can update hidden & output vectors when transitioning
     """
+    # change in the number of open constituents caused by this transition.
+    # none of the dependency transitions open anything.
+    # a class attribute rather than a method, as it never depends on the instance
+    delta_opens = 0
+
+    # integer code for the transitions which take no parameters,
+    # used to dispatch without isinstance chains or dict lookups.
+    # None for any transition which cannot be reduced to a code
+    OPCODE = None
+
     @abstractmethod
     def update_state(self, state, model):
         """
@@ -81,16 +96,16 @@ class Transition(ABC):
 
         """
 
-    def delta_opens(self):
-        return 0
-
     def apply(self, state, model):
         """
         return a new State transformed via this transition
 
-        convenience method to call bulk_apply, which is significantly
-        faster than single operations for an NN based model
+        convenience method to call bulk_apply on a batch of one State.
+        Only meant for tests and one-off use: bulk_apply is
+        significantly faster than single operations for an NN based
+        model, so loops over many States should use bulk_apply_beam
         """
+        warnings.warn("Transition.apply updates one State at a time.  Use bulk_apply_beam to update many States at once", DeprecationWarning, stacklevel=2)
         update = model.bulk_apply([state], [self])
         return update[0]
 
@@ -129,15 +144,19 @@ class Transition(ABC):
             label = self.label
         return "{}({})".format(self.short_name(), label)
 
+    @functools.cached_property
+    def sort_key(self):
+        """
+        Key used to sort transitions, computed once per instance
+
+        Puts the Shift at the front of a list, and otherwise sorts alphabetically
+        """
+        return (0 if isinstance(self, Shift) else 1, self.short_label())
+
     def __lt__(self, other):
-        # put the Shift at the front of a list, and otherwise sort alphabetically
         if self == other:
             return False
-        if isinstance(self, Shift):
-            return True
-        if isinstance(other, Shift):
-            return False
-        return str(self) < str(other)
+        return self.sort_key < other.sort_key
 
 
     @staticmethod
@@ -147,160 +166,230 @@ class Transition(ABC):
         deserialize strings in a possibly untrusted manner when
         loading from a checkpoint
         """
-        # if desc == 'Shift':
-        #     return Shift()
-        # if desc == 'CloseConstituent':
-        #     return CloseConstituent()
-        # labels = desc.split("(", maxsplit=1)
-        # if labels[0] not in ('CompoundUnary', 'OpenConstituent', 'Finalize'):
-        #     raise ValueError("Unknown Transition %s" % desc)
-        # if len(labels) == 1:
-        #     raise ValueError("Unexpected Transition repr, %s needs labels" % labels[0])
-        # if labels[1][-1] != ')':
-        #     raise ValueError("Expected Transition repr for %s: %s(labels)" % (labels[0], labels[0]))
-        # trans_type = labels[0]
-        # labels = labels[1][:-1]
-        # labels = ast.literal_eval(labels)
-        # if trans_type == 'CompoundUnary':
-        #     return CompoundUnary(*labels)
-        # if trans_type == 'OpenConstituent':
-        #     return OpenConstituent(*labels)
-        # if trans_type == 'Finalize':
-        #     return Finalize(*labels)
-        # raise ValueError("Unexpected Transition %s" % desc)
-        if desc == 'Shift':
-            return Shift()
-        if desc == 'LeftArc':
-            return LeftArc()
-        if desc == 'RightArc':
-            return RightArc()
-
-
-class Shift(Transition):
-    def update_state(self, state, model):
-        """
-        This will handle all aspects of a shift transition
+        try:
+            return TRANSITIONS_BY_NAME[desc]
+        except KeyError:
+            raise ValueError("Unknown Transition %s" % desc)
 
-        - push the top element of the word queue onto constituents
-        - pop the top element of the word queue
 
-        """
-        new_constituent = state.word_queue[state.word_position]
+def _nullary_eq(self, other):
+    if self is other:
+        return True
+    return type(other) is type(self)
 
-        return state.word_position+1, state.constituents, new_constituent, state.stacks, state.word_position, state.created_arcs
+def _nullary_hash(self):
+    return self._HASH
 
-    def is_legal(self, state, model):
-        """
-        Disallow shifting when the word queue is empty or there are no opens to eventually eat this word
-        """
-        
-        if state.is_empty_buffer():
-            return False
-        print(state)
-        return True
+def _nullary_name(self):
+    return self._NAME
 
-    def short_name(self):
-        return "Shift"
-
-    def __repr__(self):
-        return "Shift"
-
-    def __eq__(self, other):
-        if self is other:
-            return True
-        if isinstance(other, Shift):
-            return True
-        return False
-
-    def __hash__(self):
-        return hash(37)
-    
-class LeftArc(Transition):
-    def update_state(self, state, model):
-        """
-        This will handel all aspects of a left arc transition
+def _nullary_transition(name, opcode, update_state, is_legal, hash_value):
+    """
+    Build a Transition class which takes no parameters
 
-        - create a new arc in the stack by using the last two word, the left one being the head
-        - pop the last word from the stack
+    Shift, LeftArc and RightArc only differ in how they update the
+    state and when they are legal.  Equality, hashing and naming are
+    the same shared functions for each of them.
+    """
+    return ABCMeta(name, (Transition,), {
+        '__module__': __name__,
+        'OPCODE': opcode,
+        '_NAME': name,
+        '_HASH': hash(hash_value),
+        'update_state': update_state,
+        'is_legal': is_legal,
+        'short_name': _nullary_name,
+        '__repr__': _nullary_name,
+        '__eq__': _nullary_eq,
+        '__hash__': _nullary_hash,
+    })
+
+def _shift_update_state(self, state, model):
+    """
+    This will handle all aspects of a shift transition
 
-        """
-        constituents = state.constituents[2:]
-        stacks = state.stacks[2:]
-        new_constituent = state.constituents[1]
-        new_stacks = state.stacks[1]
-        # add new arc
-        new_arc = (constituents[1].value, constituents[0].value)
+    - push the top element of the word queue onto constituents
+    - pop the top element of the word queue
 
-        return state.word_position, constituents, new_constituent, stacks, new_stacks, state.created_arcs.push(new_arc)
+    """
+    # word_queue[0] is the sentinel standing in for ROOT, so the words
+    # are numbered from 1, same as the ids in the oracle
+    word = state.word_position + 1
+    new_constituent = state.word_queue[word]
 
+    return word, state.constituents, new_constituent, state.stacks, word, state.created_arcs
 
-    def is_legal(self, state, model):
-        """
-        Disallow left arc when there are less than two words in the stack
-        """
-        print(state)
-        if state.num_stacks >= 2:
-            return True
+def _shift_is_legal(self, state, model):
+    """
+    Disallow shifting when the word queue is empty or there are no opens to eventually eat this word
+    """
+    return not state.empty_word_queue()
 
-    def short_name(self):
-        return "LeftArc"
+def _leftarc_update_state(self, state, model):
+    """
+    This will handel all aspects of a left arc transition
 
-    def __repr__(self):
-        return "LeftArc"
+    - create a new arc in the stack by using the last two word, the left one being the head
+    - pop the last word from the stack
 
-    def __eq__(self, other):
-        if self is other:
-            return True
-        if isinstance(other, LeftArc):
-            return True
-        return False
+    """
+    # the top two items are popped and the head is pushed back on
+    constituents = state.constituents
+    stacks = state.stacks
+    head = stacks[-2]
+    new_constituent = model.get_top_constituent(constituents.parent)
+    # add new arc: (head, dependent) as positions in the word queue
+    new_arc = (head, stacks[-1])
 
-    def __hash__(self):
-        return hash(17)
-        
+    return state.word_position, constituents.parent.parent, new_constituent, stacks[:-2], head, state.created_arcs.push(new_arc)
 
-class RightArc(Transition):
-    def update_state(self, state, model):
-        """
-        This will handel all aspects of a right arc transition
+def _rightarc_update_state(self, state, model):
+    """
+    This will handel all aspects of a right arc transition
 
-        - create a new arc in the stack by using the last two word, the right one being the head
-        - pop the last word from the stack
-        """
-        constituents = state.constituents[2:]
-        stacks = state.stacks[2:]
-        new_constituent = state.constituents[0]
-        new_stacks = state.stacks[0]
-        # add new arc
-        new_arc = (constituents[0].value, constituents[1].value)
+    - create a new arc in the stack by using the last two word, the right one being the head
+    - pop the last word from the stack
+    """
+    # the top two items are popped and the head is pushed back on
+    constituents = state.constituents
+    stacks = state.stacks
+    head = stacks[-1]
+    new_constituent = model.get_top_constituent(constituents)
+    # add new arc: (head, dependent) as positions in the word queue
+    new_arc = (head, stacks[-2])
 
-        return state.word_position, constituents, new_constituent, stacks, new_stacks, state.created_arcs.push(new_arc)
+    return state.word_position, constituents.parent.parent, new_constituent, stacks[:-2], head, state.created_arcs.push(new_arc)
 
+def _leftarc_is_legal(self, state, model):
+    """
+    Disallow an arc when there are less than two words in the stack
 
-    def is_legal(self, state, model):
-        """
-        Disallow left arc when there are less than two words in the stack
-        """
-        print(state)
-        if state.num_stacks >= 2:
-            return True
+    ROOT counts as one of the two, as it can be the head of a left arc
+    """
+    return state.num_stacks >= 2
 
-    def short_name(self):
-        return "RightArc"
+def _rightarc_is_legal(self, state, model):
+    """
+    Disallow an arc unless there are two words in the stack above ROOT
+
+    A right arc would make ROOT the dependent of the top word
+    """
+    return state.num_stacks >= 3
+
+Shift = _nullary_transition("Shift", 0, _shift_update_state, _shift_is_legal, 37)
+LeftArc = _nullary_transition("LeftArc", 1, _leftarc_update_state, _leftarc_is_legal, 17)
+RightArc = _nullary_transition("RightArc", 2, _rightarc_update_state, _rightarc_is_legal, 71)
+
+SHIFT = Shift()
+LEFTARC = LeftArc()
+RIGHTARC = RightArc()
+
+# the transitions have no state, so one instance of each is shared
+# by the oracle, the models, and anything loaded from a checkpoint
+TRANSITIONS_BY_NAME = {
+    'Shift': SHIFT,
+    'LeftArc': LEFTARC,
+    'RightArc': RIGHTARC,
+}
+
+# the stateless transitions indexed by OPCODE, so an opcode can be
+# turned back into its transition with a tuple index
+NULLARY_TRANSITIONS = (SHIFT, LEFTARC, RIGHTARC)
+
+def step(word_position, sentence_length, stack_len, trans_id):
+    """
+    Apply a transition using only the buffer position and the stack size
+
+    trans_id is the OPCODE of the transition.  Returns the new word_position,
+    the new stack size, and whether or not the transition was legal.
+    An illegal transition leaves the position and stack unchanged.
+    stack_len includes ROOT, same as State.num_stacks.
+    """
+    if trans_id == 0:
+        if word_position < sentence_length:
+            return word_position + 1, stack_len + 1, True
+        return word_position, stack_len, False
+    # RightArc cannot make ROOT a dependent, so it needs a word under the top
+    if stack_len >= 2 + (trans_id == 2):
+        return word_position, stack_len - 1, True
+    return word_position, stack_len, False
+
+def _first_illegal(trans_ids, sentence_length):
+    word_position = 0
+    # the stack starts with ROOT on it
+    stack_len = 1
+    for idx in range(trans_ids.shape[0]):
+        word_position, stack_len, legal = step(word_position, sentence_length, stack_len, trans_ids[idx])
+        if not legal:
+            return idx
+    return -1
+
+def _legality_table():
+    """
+    Legality of each stateless transition, indexed by OPCODE and then by empty_buffer * 4 + min(num_stacks, 3)
+
+    Built from step, so legal_mask and first_illegal_transition agree
+    """
+    table = np.zeros((len(NULLARY_TRANSITIONS), 8), dtype=bool)
+    for opcode in range(len(NULLARY_TRANSITIONS)):
+        for empty_buffer in (0, 1):
+            for num_stacks in range(4):
+                # a one word sentence: position 1 is an empty buffer
+                table[opcode, empty_buffer * 4 + num_stacks] = step(empty_buffer, 1, num_stacks, opcode)[2]
+    return table
+
+LEGALITY_TABLE = _legality_table()
 
-    def __repr__(self):
-        return "RightArc"
+if numba is not None:
+    step = numba.njit(cache=True)(step)
+    _first_illegal = numba.njit(cache=True)(_first_illegal)
 
-    def __eq__(self, other):
-        if self is other:
-            return True
-        if isinstance(other, RightArc):
-            return True
-        return False
+def first_illegal_transition(sequence, sentence_length):
+    """
+    Return the index of the first transition in the sequence which is not legal, or -1 if they all are
+
+    Starts from a stack holding only ROOT at the start of the buffer.  This runs
+    without building any States, and is compiled with numba if that is
+    installed.
+    """
+    trans_ids = np.fromiter((trans.OPCODE for trans in sequence), dtype=np.int8, count=len(sequence))
+    return _first_illegal(trans_ids, sentence_length)
+
+def legal_mask(states, transitions, model=None):
+    """
+    Return a (len(states), len(transitions)) boolean array of which transitions are legal in which states
+
+    Whether the buffer is empty and the stack size are read once per state rather
+    than once per (state, transition) pair, as happens when calling
+    is_legal in a loop over the beam.  The stateless transitions are
+    then looked up in LEGALITY_TABLE.
+    Other transitions fall back to their own is_legal.
+    """
+    num_states = len(states)
+    empty_buffer = np.fromiter((state.empty_word_queue() for state in states), dtype=bool, count=num_states)
+    num_stacks = np.fromiter((state.num_stacks for state in states), dtype=np.int32, count=num_states)
+
+    buckets = empty_buffer * 4 + np.minimum(num_stacks, 3)
+
+    mask = np.empty((num_states, len(transitions)), dtype=bool)
+    for trans_idx, transition in enumerate(transitions):
+        opcode = transition.OPCODE
+        if opcode is not None:
+            mask[:, trans_idx] = LEGALITY_TABLE[opcode, buckets]
+        else:
+            mask[:, trans_idx] = [transition.is_legal(state, model) for state in states]
+    return mask
+
+def bulk_apply_beam(states, transitions, model, fail=False):
+    """
+    Apply one transition to each of the states with a single call to model.bulk_apply
+
+    This is the way to advance a beam or batch of States by one step.
+    Calling Transition.apply on each State in a loop pays the batching
+    overhead of the model once per State instead of once per step.
+    """
+    return model.bulk_apply(states, transitions, fail=fail)
 
-    def __hash__(self):
-        return hash(71)
-    
 def check_transitions(train_transitions, other_transitions, treebank_name):
     """
     Check that all the transitions in the other dataset are known in the train set
@@ -312,6 +401,8 @@ def check_transitions(train_transitions, other_transitions, treebank_name):
     If this is an unknown compound transition, we won't possibly get it
     right when parsing, but at least we don't need to fail
     """
+    # train_transitions is usually a sorted list, so check membership in a set instead
+    train_transitions = frozenset(train_transitions)
     unknown_transitions = set()
     for trans in other_transitions:
         if trans not in train_transitions:
@@ -320,4 +411,4 @@ def check_transitions(train_transitions, other_transitions, treebank_name):
                     raise RuntimeError("Found transition {} in the {} set which don't exist in the train set".format(trans, treebank_name))
             unknown_transitions.add(trans)
     if len(unknown_transitions) > 0:
-        logger.warning("Found transitions where the components are all valid transitions, but the complete transition is unknown: %s", sorted(unknown_transitions))
\ No newline at end of file
+        logger.warning("Found transitions where the components are all valid transitions, but the complete transition is unknown: %s", sorted(unknown_transitions, key=lambda x: x.sort_key))
\ No newline at end of file
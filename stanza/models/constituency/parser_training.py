@@ -156,9 +156,9 @@ def build_trainer(args, train_trees, dev_trees, silver_trees, foundation_cache,
     #     unary_limit = max(unary_limit, max(t.count_unary_depth() for t in silver_trees))
     tlogger.info("Unary limit: %d", unary_limit)
     
-    train_sequences, train_transitions = transition_sequence.convert_trees_to_sequences(train_trees, "training", args['transition_scheme'], args['reversed'])
-    dev_sequences, dev_transitions = transition_sequence.convert_trees_to_sequences(dev_trees, "dev", args['transition_scheme'], args['reversed'])
-    silver_sequences, silver_transitions = transition_sequence.convert_trees_to_sequences(silver_trees, "silver", args['transition_scheme'], args['reversed'])
+    train_sequences, train_transitions = transition_sequence.convert_trees_to_sequences(train_trees, "training", args['transition_scheme'], args['reversed'], args.get('oracle_workers', 1))
+    dev_sequences, dev_transitions = transition_sequence.convert_trees_to_sequences(dev_trees, "dev", args['transition_scheme'], args['reversed'], args.get('oracle_workers', 1))
+    silver_sequences, silver_transitions = transition_sequence.convert_trees_to_sequences(silver_trees, "silver", args['transition_scheme'], args['reversed'], args.get('oracle_workers', 1))
     
     tlogger.info("Total unique transitions in train set: %d", len(train_transitions))
     tlogger.info("Unique transitions in training set:\n  %s", "\n  ".join(map(str, train_transitions)))
@@ -1,9 +1,4 @@
-from collections import namedtuple
-
-class State(namedtuple('State', ['word_queue', 'transitions', 'constituents', 'stacks', 'created_arcs', 
-                                 'gold_tree', 'gold_sequence',
-                                 'sentence_length', 'word_position', 'score', 'num_opens'])):
-    
+class State:
     """
     Represents a partially completed transition parse
 
@@ -11,19 +6,55 @@ class State(namedtuple('State', ['word_queue', 'transitions', 'constituents', 's
         ?(The word_queue should have both a start and an end word.)
     - transitions: list of transitions taken to reach this state
     - constituents: list of word forms in the stack (naming is for compatibility with constituency parser)
-    - stack: list of indices in the stack
-    - created_arcs: set of (head, dependent) tuples representing arcs created so far
+    - stacks: tuple of word_queue indices in the stack, with the top at the end.
+        word_queue[0] is the start sentinel, which stands in for ROOT, so the words
+        are numbered from 1 and the stack starts as (0,)
+    - created_arcs: TreeStack of the arcs created so far, each a (head, dependent) tuple
+        of word_queue indices, so ROOT is 0
     - gold_tree: set of (head, dependent) tuples representing the gold arcs for this sentence, might be None (None in runtime)
     - gold_sequence: the original transition sequence, might be None (None in runtime)
     - sentence_length: length of the sentence
-    - word_position: current position of the buffer in the word queue
+    - word_position: number of words shifted so far.  The next word is word_queue[word_position+1]
 
+    States are created once per transition per sentence, so this is a
+    slotted class rather than a namedtuple.  _replace is kept so
+    callers can continue to treat it as an immutable record.
     """
+    _fields = ('word_queue', 'transitions', 'constituents', 'stacks', 'created_arcs',
+               'gold_tree', 'gold_sequence',
+               'sentence_length', 'word_position', 'score', 'num_opens')
+    # the legality checks ask these for every transition at every step,
+    # so they are computed once when the State is built
+    __slots__ = _fields + ('_empty_buffer', '_num_stacks')
+
+    def __init__(self, word_queue, transitions, constituents, stacks, created_arcs,
+                 gold_tree, gold_sequence, sentence_length, word_position, score, num_opens):
+        self.word_queue = word_queue
+        self.transitions = transitions
+        self.constituents = constituents
+        self.stacks = stacks
+        self.created_arcs = created_arcs
+        self.gold_tree = gold_tree
+        self.gold_sequence = gold_sequence
+        self.sentence_length = sentence_length
+        self.word_position = word_position
+        self.score = score
+        self.num_opens = num_opens
+        self._empty_buffer = word_position == sentence_length
+        self._num_stacks = len(stacks)
+
+    def _replace(self, **kwargs):
+        """
+        Return a new State with the given fields replaced, same as namedtuple._replace
+        """
+        fields = {field: getattr(self, field) for field in State._fields}
+        fields.update(kwargs)
+        return State(**fields)
 
     def empty_word_queue(self):
-        # the first element of each stack is a sentinel with no value
-        # and no parent
-        return self.word_position == self.sentence_length
+        # computed once in __init__, as the legality checks ask for it
+        # for every transition at every step
+        return self._empty_buffer
 
     def empty_transitions(self):
         # the first element of each stack is a sentinel with no value
@@ -43,7 +74,8 @@ class State(namedtuple('State', ['word_queue', 'transitions', 'constituents', 's
     
     @property
     def empty_stacks(self):
-        return self.stack.length == 0
+        # only ROOT is left on the stack
+        return self._num_stacks == 1
 
     @property
     def num_transitions(self):
@@ -52,7 +84,7 @@ class State(namedtuple('State', ['word_queue', 'transitions', 'constituents', 's
     
     @property
     def num_stacks(self):
-        return self.stacks.length - 1
+        return self._num_stacks
 
     @property
     def get_word(self, pos):
@@ -65,40 +97,27 @@ class State(namedtuple('State', ['word_queue', 'transitions', 'constituents', 's
 
 
     def all_transitions(self, model):
-        # TODO: rewrite this to be nicer / faster?  or just refactor?
-        all_transitions = []
-        transitions = self.transitions
-        while transitions.parent is not None:
-            all_transitions.append(model.get_top_transition(transitions))
-            transitions = transitions.parent
-        return list(reversed(all_transitions))
-    
+        # [1:] skips the sentinel at the bottom of the stack
+        return [model.get_top_transition(transitions) for transitions in self.transitions.flattened[1:]]
+
     def all_constituents(self, model):
-        # TODO: rewrite this to be nicer / faster?
-        all_constituents = []
-        constituents = self.constituents
-        while constituents.parent is not None:
-            all_constituents.append(model.get_top_constituent(constituents))
-            constituents = constituents.parent
-        return list(reversed(all_constituents))
+        # [1:] skips the sentinel at the bottom of the stack
+        return [model.get_top_constituent(constituents) for constituents in self.constituents.flattened[1:]]
     
     def all_stacks(self, model):
-        all_stacks = []
-        stacks = self.stacks
         words = self.word_queue
-        for id in stacks:
-            all_stacks.append(words[id])
-        return all_stacks
+        return [words[idx] for idx in self.stacks]
     
     def all_buffers(self, model):
-        return self.word_queue[self.word_position:]
+        # +1 and -1 skip the shifted words and the end sentinel
+        return self.word_queue[self.word_position+1:-1]
     
     def all_created_arcs(self, model):
-        created_arcs = self.created_arcs
-        all_created_arcs = []
-        for (h, d) in created_arcs:
-            all_created_arcs.append((self.word_queue[h], self.word_queue[d]))
-        return all_created_arcs
+        # [1:] skips the sentinel at the bottom of the stack,
+        # which leaves the arcs in the order they were created.
+        # ROOT is reported as word_queue[0], the start sentinel
+        words = self.word_queue
+        return [(words[arcs.value[0]], words[arcs.value[1]]) for arcs in self.created_arcs.flattened[1:]]
 
     def all_words(self, model):
         return [model.get_word(x) for x in self.word_queue]
@@ -107,19 +126,12 @@ class State(namedtuple('State', ['word_queue', 'transitions', 'constituents', 's
         return "State(\n  stacks:%s\n  buffers:%s\  transitions:%s\n)" % (str(self.all_words(model)), str(self.all_transitions(model)), str(self.all_constituents(model)), self.word_position, self.num_opens)
 
     def __str__(self):
-        """'word_queue', 'transitions', 'stacks', 'created_arcs', 
-                                 'gold_arcs', 'gold_sequence',
-                                 'sentence_length', 'word_position', 'score'"""
-        
-        print("------------------------------")
-        print(f"word_queue: {self.word_queue}")
-        print(f"transitions: {self.transitions}")
-        print(f"stacks: {self.stacks}")
-        print(f"created_arcs: {self.created_arcs}")
-        # print(f"gold_trees: {self.gold_trees}")
-        print(f"gold_sequence: {self.gold_sequence}")
-        print(f"sentence_length: {self.sentence_length}")
-        print(f"word_position: {self.word_position}")
-        print(f"score: {self.score}")
-
-        return None
\ No newline at end of file
+        return ("------------------------------\n"
+                f"word_queue: {self.word_queue}\n"
+                f"transitions: {self.transitions}\n"
+                f"stacks: {self.stacks}\n"
+                f"created_arcs: {self.created_arcs}\n"
+                f"gold_sequence: {self.gold_sequence}\n"
+                f"sentence_length: {self.sentence_length}\n"
+                f"word_position: {self.word_position}\n"
+                f"score: {self.score}")
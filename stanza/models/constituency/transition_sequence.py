@@ -1,95 +1,171 @@
 """
-Build a transition sequence from parse trees.
+Build arc-standard transition sequences from UD dependency trees.
 
-Supports multiple transition schemes - TOP_DOWN and variants, IN_ORDER
+The oracle works on an int32 array of heads per sentence and is
+compiled with numba if that is installed.
 """
 
+from concurrent.futures import ProcessPoolExecutor
 import logging
 
-from stanza.models.common import utils
-# from stanza.models.constituency.parse_transitions import Shift, CompoundUnary, OpenConstituent, CloseConstituent, TransitionScheme, Finalize
-from stanza.models.constituency.parse_transitions import Shift, LeftArc, RightArc, TransitionScheme
-from stanza.models.constituency.parse_transitions import TransitionScheme
-from stanza.models.constituency.tree_reader import read_trees
+import numpy as np
+
+try:
+    import numba
+    prange = numba.prange
+except ImportError:
+    numba = None
+    prange = range
+
+from stanza.models.constituency.parse_transitions import NULLARY_TRANSITIONS, SHIFT, LEFTARC, RIGHTARC, TransitionScheme
 from stanza.utils.get_tqdm import get_tqdm
 from stanza.utils.conll import CoNLL
-from collections import defaultdict
 
 tqdm = get_tqdm()
 
 logger = logging.getLogger('stanza.constituency.trainer')
 
+# below this many trees, starting worker processes costs more than it saves
+MIN_TREES_FOR_WORKERS = 500
+
+# how many trees treebank_transitions runs through the oracle at once
+TRANSITIONS_CHUNK_SIZE = 10000
+
+# integer codes used by the oracle, which are turned back into
+# transitions with NULLARY_TRANSITIONS
+SHIFT_CODE = SHIFT.OPCODE
+LEFTARC_CODE = LEFTARC.OPCODE
+RIGHTARC_CODE = RIGHTARC.OPCODE
+
+def _oracle_steps(heads, steps):
+    """
+    Arc-standard oracle over an array of heads
+
+    heads[i] is the head of word i, with the words numbered from 1 and
+    heads[0] standing in for ROOT.  The OPCODE of each transition is
+    written to steps, which needs room for 2N transitions for N words.
+    Returns False if the tree is not projective.
+
+    Works on integers only so that it can be compiled with numba if
+    that is installed.  Failure is returned rather than raised, as
+    numba cannot raise from inside a parallel loop.
+    """
+    num_words = heads.shape[0] - 1
+
+    # number of dependents each word is still waiting on.
+    # a word can only be attached to its head once this reaches 0
+    pending = np.bincount(heads[1:], minlength=num_words + 1)
+
+    num_steps = 0
+
+    stack = np.empty(num_words + 1, dtype=np.int32)
+    stack[0] = 0  # start with ROOT on stack
+    stack_len = 1
+    buffer_idx = 1
+
+    while buffer_idx <= num_words or stack_len > 1:
+        if stack_len >= 2:
+            # the two words an arc could join, read once per step
+            top = stack[stack_len - 1]
+            second = stack[stack_len - 2]
+            if heads[second] == top and pending[second] == 0:
+                # the top of the stack is the head of the word below it
+                steps[num_steps] = RIGHTARC_CODE
+                num_steps += 1
+                stack_len -= 1
+                stack[stack_len - 1] = top
+                pending[top] -= 1
+                continue
+            if heads[top] == second and pending[top] == 0:
+                # the word below the top of the stack is the head of the top
+                steps[num_steps] = LEFTARC_CODE
+                num_steps += 1
+                stack_len -= 1
+                pending[second] -= 1
+                continue
+        if buffer_idx > num_words:
+            return False
+        steps[num_steps] = SHIFT_CODE
+        num_steps += 1
+        stack[stack_len] = buffer_idx
+        stack_len += 1
+        buffer_idx += 1
+
+    return True
 
+def _oracle_batch(heads, offsets, steps, projective):
+    """
+    Run the oracle on many trees at once
+
+    The heads of tree i are heads[offsets[i]:offsets[i+1]], including
+    its ROOT slot.  The transitions of tree i are written to steps
+    starting at twice the number of words in the trees before it, and
+    projective[i] records whether the oracle succeeded on that tree.
+    """
+    for tree_idx in prange(offsets.shape[0] - 1):
+        start = offsets[tree_idx]
+        end = offsets[tree_idx + 1]
+        # the ROOT slot of each tree does not produce transitions
+        step_start = 2 * (start - tree_idx)
+        step_end = step_start + 2 * (end - start - 1)
+        projective[tree_idx] = _oracle_steps(heads[start:end], steps[step_start:step_end])
+
+if numba is not None:
+    _oracle_steps = numba.njit(cache=True)(_oracle_steps)
+    _oracle_batch = numba.njit(cache=True, parallel=True)(_oracle_batch)
+
+def oracle(heads):
+    """
+    Return an int8 array of the OPCODEs of the oracle transitions for one array of heads
 
-def do_shift(buffer, stack, steps, done): 
-    steps.append([buffer[:], stack[:], Shift()])
-    stack.append(buffer.pop(0))
+    heads[i] is the head of word i, with heads[0] standing in for ROOT.
+    Runs through numba if that is installed, and otherwise as plain
+    python.  NULLARY_TRANSITIONS[code] turns a code back into its
+    transition.
 
-def do_rightarc(buffer, stack, steps, done):
-    steps.append([buffer[:], stack[:], RightArc()])
-    done.add(stack.pop(-2))
-    
-def do_leftarc(buffer, stack, steps, done):
-    steps.append([buffer[:], stack[:], LeftArc()])
-    done.add(stack.pop(-1))
+    Raises ValueError if the tree is not projective.
+    """
+    heads = np.ascontiguousarray(heads, dtype=np.int32)
+    # N shifts and N arcs, counting the arc from ROOT
+    steps = np.empty(2 * (heads.shape[0] - 1), dtype=np.int8)
+    if not _oracle_steps(heads, steps):
+        raise ValueError("Non-projective tree or stuck parser.")
+    return steps
+
+def _oracle_worker(heads):
+    """
+    Run the oracle on one array of heads in a worker process
 
-def is_done(dependent, dependents, done):
-    return all(d in done for d in dependents[dependent])
+    Returns the OPCODEs and whether the tree was projective, the same
+    as _oracle_batch, so both paths report a failure the same way
+    """
+    steps = np.empty(2 * (heads.shape[0] - 1), dtype=np.int8)
+    return steps, _oracle_steps(heads, steps)
+
+def _sentence_heads(sentence):
+    """
+    Return the heads of a sentence as an int32 array indexed by word id, with -1 for ROOT
+
+    Multi-word tokens and empty nodes, which have ids such as (1, 2)
+    or (1, 1), are skipped, leaving the words in id order.  The
+    tokens themselves are not modified.
+    """
+    # -1 as ROOT has no head
+    heads = [-1]
+    heads.extend(token['head'] for token in sentence if len(token['id']) == 1)
+    return np.array(heads, dtype=np.int32)
 
 def UD_to_oracle(sentence):
     """
-    Convert a projective UD tree to arc-standard oracle steps using the do_shift/do_rightarc/do_leftarc functions.
+    Convert a projective UD tree to arc-standard oracle steps
 
     Args:
         sentence (List[Dict]): Each token has 'id' and 'head' fields.
 
     Returns:
-        List[List]: Each step as [buffer, stack, action]
-    """ 
-    # print("printing sentence")
-    # print(sentence)
-
-    for token in sentence:
-            token["id"] =  token["id"][0]
-    
-    # Add ROOT node
-    root = {'id': 0, 'form': 'ROOT', 'head': None}
-    tokens = [root] + sentence
-
-    heads = {tok['id']: tok['head'] for tok in tokens if tok['id'] != 0}
-    dependents = defaultdict(list)
-    for tok in tokens:
-        if tok['head'] not in (None, -1):
-            dependents[tok['head']].append(tok['id'])
-
-    buffer = [tok['id'] for tok in tokens if tok['id'] != 0]  # exclude ROOT from buffer
-    stack = [0]  # start with ROOT on stack
-    done = set()
-    steps = []
-
-    def can_RightArc():
-        if len(stack) < 2:
-            return False
-        s1, s0 = stack[-2], stack[-1]
-        return heads.get(s1) == s0 and is_done(s1, dependents, done)
-
-    def can_LeftArc():
-        if len(stack) < 2:
-            return False
-        s1, s0 = stack[-2], stack[-1]
-        return heads.get(s0) == s1 and is_done(s0, dependents, done)
-
-    while buffer or len(stack) > 1:
-        if can_RightArc():
-            do_rightarc(buffer, stack, steps, done)
-        elif can_LeftArc():
-            do_leftarc(buffer, stack, steps, done)
-        elif buffer:
-            do_shift(buffer, stack, steps, done)
-        else:
-            raise ValueError("Non-projective tree or stuck parser.")
-
-    return [transition for _, _, transition in steps]
+        List[Transition]: the transitions, in order
+    """
+    return [NULLARY_TRANSITIONS[code] for code in oracle(_sentence_heads(sentence))]
 
 
 def build_sequence(tree, transition_scheme=TransitionScheme.IN_ORDER):
@@ -98,15 +174,77 @@ def build_sequence(tree, transition_scheme=TransitionScheme.IN_ORDER):
     """
     return UD_to_oracle(tree)
 
-def build_treebank(trees, transition_scheme=TransitionScheme.IN_ORDER, reverse=False):
+def _treebank_codes(trees, workers=1):
+    """
+    Run the oracle on the trees, keeping the transitions as OPCODEs
+
+    Returns an int8 array of the OPCODEs of each distinct tree, back
+    to back, the offsets of each distinct tree in that array, and the
+    index of the distinct tree for each of the trees
+    """
+    # identical trees have identical transitions, so the oracle only
+    # runs once for each distinct array of heads
+    unique_trees = {}
+    heads = []
+    tree_to_unique = []
+    for tree in trees:
+        tree_heads = _sentence_heads(tree)
+        key = tree_heads.tobytes()
+        if key not in unique_trees:
+            unique_trees[key] = len(heads)
+            heads.append(tree_heads)
+        tree_to_unique.append(unique_trees[key])
+
+    # all of the trees go through the oracle in one call, laid out as
+    # one flat array of heads with offsets marking where each tree starts
+    offsets = np.zeros(len(heads) + 1, dtype=np.int64)
+    np.cumsum([len(tree_heads) for tree_heads in heads], out=offsets[1:])
+    step_offsets = 2 * (offsets - np.arange(len(heads) + 1))
+
+    # every tree has exactly 2N transitions, so the output is allocated
+    # once at its final size and each tree is written in place
+    steps = np.empty(step_offsets[-1], dtype=np.int8)
+    projective = np.empty(len(heads), dtype=np.bool_)
+    if numba is None and workers > 1 and len(heads) >= MIN_TREES_FOR_WORKERS:
+        # without numba, the oracle is a python loop, so split the trees over processes.
+        # _oracle_worker is a module level function, so it can be sent to the workers
+        chunksize = max(1, len(heads) // (workers * 8))
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_oracle_worker, heads, chunksize=chunksize)
+            for tree_idx, (tree_steps, tree_projective) in enumerate(results):
+                steps[step_offsets[tree_idx]:step_offsets[tree_idx+1]] = tree_steps
+                projective[tree_idx] = tree_projective
+    else:
+        _oracle_batch(np.concatenate(heads), offsets, steps, projective)
+    if not projective.all():
+        raise ValueError("Non-projective tree or stuck parser in tree %d" % tree_to_unique.index(np.argmin(projective)))
+
+    return steps, step_offsets, tree_to_unique
+
+def _decode_treebank(steps, step_offsets, tree_to_unique):
+    """
+    Turn the OPCODEs from _treebank_codes into a list of transitions for each tree
+    """
+    # slicing gives each tree its own list, even when trees were duplicates
+    steps = [NULLARY_TRANSITIONS[code] for code in steps.tolist()]
+    step_offsets = step_offsets.tolist()
+    return [steps[step_offsets[idx]:step_offsets[idx+1]] for idx in tree_to_unique]
+
+def build_treebank(trees, transition_scheme=TransitionScheme.IN_ORDER, reverse=False, workers=1):
     """
     Turn each of the trees in the treebank into a list of transitions based on the TransitionScheme
+
+    If numba is not installed, workers > 1 spreads large treebanks
+    over that many processes.  With numba, the batched oracle
+    already runs in parallel and workers is ignored.
     """
     # if reverse:
     #     return [build_sequence(tree.reverse(), transition_scheme) for tree in trees]
     # else:
     #     return [build_sequence(tree, transition_scheme) for tree in trees]
-    return [build_sequence(tree, transition_scheme) for tree in trees]
+    if len(trees) == 0:
+        return []
+    return _decode_treebank(*_treebank_codes(trees, workers))
 
 def all_transitions(transition_lists):
     """
@@ -117,22 +255,43 @@ def all_transitions(transition_lists):
         transitions.update(trans_list)
     return sorted(transitions)
 
-def convert_trees_to_sequences(trees, treebank_name, transition_scheme, reverse=False):
+def treebank_transitions(trees, workers=1, chunk_size=TRANSITIONS_CHUNK_SIZE):
+    """
+    Return the sorted list of transitions used by the trees, without keeping their sequences
+
+    The same result as all_transitions(build_treebank(trees)), but the
+    trees go through the oracle chunk_size at a time and only the
+    distinct OPCODEs of each chunk are kept, so memory does not grow
+    with the size of the treebank
     """
-    Wrap both build_treebank and all_transitions, possibly with a tqdm
+    codes = set()
+    for start in range(0, len(trees), chunk_size):
+        steps, _, _ = _treebank_codes(trees[start:start+chunk_size], workers)
+        codes.update(np.unique(steps).tolist())
+    return sorted(NULLARY_TRANSITIONS[code] for code in codes)
 
-    Converts trees to a list of sequences, then returns the list of known transitions
+def convert_trees_to_sequences(trees, treebank_name, transition_scheme, reverse=False, workers=1):
+    """
+    Build the transition sequences of a treebank and the list of known transitions
+
+    Does the same work as build_treebank followed by all_transitions,
+    but finds the known transitions from the oracle's OPCODEs
     """
     if len(trees) == 0:
         return [], []
-    
+
     trees = trees[0]
 
     logger.info("Building %s transition sequences", treebank_name)
     # if logger.getEffectiveLevel() <= logging.INFO:
     #     trees = tqdm(trees)
-    sequences = build_treebank(trees, transition_scheme, reverse)
-    transitions = all_transitions(sequences)
+    if len(trees) == 0:
+        return [], []
+    steps, step_offsets, tree_to_unique = _treebank_codes(trees, workers)
+    sequences = _decode_treebank(steps, step_offsets, tree_to_unique)
+    # the known transitions come from the distinct OPCODEs, rather
+    # than a set built from every transition of every tree
+    transitions = sorted(NULLARY_TRANSITIONS[code] for code in np.unique(steps).tolist())
     return sequences, transitions
 
 def main():
@@ -3,6 +3,7 @@ A utilitiy class for keeping track of intermediate parse states
 """
 
 from collections import namedtuple
+import functools
 
 class TreeStack(namedtuple('TreeStack', ['value', 'parent', 'length'])):
     """
@@ -38,6 +39,32 @@ class TreeStack(namedtuple('TreeStack', ['value', 'parent', 'length'])):
         # returns a new stack node which points to this
         return TreeStack(value, self, self.length+1)
 
+    @functools.cached_property
+    def flattened(self):
+        """
+        A tuple of the nodes from the bottom of the stack up to and including this node
+
+        Memoized on the node, so later calls on this node or on any
+        stack pushed on top of it only walk back to the nearest node
+        which has already been flattened
+
+        The trade-off is memory: each flattened node keeps its own
+        tuple of the whole prefix, so flattening every node of a stack
+        of depth n keeps O(n^2) references alive for as long as the
+        nodes are.  The stacks here are bounded by the sentence length,
+        and only the nodes a caller asks for are flattened.
+        """
+        nodes = []
+        stack = self
+        # cached_property stores its value in the instance __dict__
+        # under the name of the property, which is how the walk knows
+        # where an earlier flattening stopped
+        while stack is not None and 'flattened' not in stack.__dict__:
+            nodes.append(stack)
+            stack = stack.parent
+        prefix = stack.flattened if stack is not None else ()
+        return prefix + tuple(reversed(nodes))
+
     def __iter__(self):
         stack = self
         while stack.parent is not None:
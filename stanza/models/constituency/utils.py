@@ -12,7 +12,7 @@ from torch import optim
 from stanza.models.common.doc import TEXT, Document
 from stanza.models.common.utils import get_optimizer
 from stanza.models.constituency.base_model import SimpleModel
-from stanza.models.constituency.parse_transitions import TransitionScheme
+from stanza.models.constituency.parse_transitions import TransitionScheme, bulk_apply_beam, first_illegal_transition
 from stanza.models.constituency.parse_tree import Tree
 from stanza.utils.get_tqdm import get_tqdm
 
@@ -293,33 +293,56 @@ def get_open_nodes(trees, transition_scheme):
 def verify_transitions(trees, sequences, transition_scheme, unary_limit, reverse, name, root_labels):
     """
     Given a list of trees and their transition sequences, verify that the sequences rebuild the trees
+
+    trees is the same [sentences] structure passed to convert_trees_to_sequences.
+    The arcs built by each sequence are compared with the gold heads.
     """
     model = SimpleModel(transition_scheme, unary_limit, reverse, root_labels)
+    trees = trees[0]
     tlogger.info("Verifying the transition sequences for %d trees", len(trees))
 
-    trees = trees[0]
     flattentrees = ud_to_flatentrees(trees)
-    data = zip(trees, flattentrees, sequences)
+    # TODO: make the SimpleModel have a parse operation?
+    states = model.initial_state_from_gold_trees(flattentrees)
     # if tlogger.getEffectiveLevel() <= logging.INFO:
     #     data = tqdm(zip(trees, sequences), total=len(trees))
 
-    for tree_idx, (tree, flattentree, sequence) in enumerate(data):
-        # TODO: make the SimpleModel have a parse operation?
-        state = model.initial_state_from_gold_trees([flattentree])[0]
-        print("print initial state")
-        print(state)
-        
-        for idx, trans in enumerate(sequence):
-            if not trans.is_legal(state, model):
-                raise RuntimeError("Tree {} of {} failed: transition {}:{} was not legal in a transition sequence:\nOriginal tree: {}\nTransitions: {}".format(tree_idx, name, idx, trans, tree, sequence))
-            state = trans.apply(state, model)
-            print("print state")
-            print(state)
-        result = model.get_top_constituent(state.constituents)
-        if reverse:
-            result = result.reverse()
-        if tree != result:
-            raise RuntimeError("Tree {} of {} failed: transition sequence did not match for a tree!\nOriginal tree:{}\nTransitions: {}\nResult tree:{}".format(tree_idx, name, tree, sequence, result))
+    for tree_idx, (tree, state, sequence) in enumerate(zip(trees, states, sequences)):
+        # check the legality of the whole sequence up front, without building States
+        idx = first_illegal_transition(sequence, state.sentence_length)
+        if idx >= 0:
+            raise RuntimeError("Tree {} of {} failed: transition {}:{} was not legal in a transition sequence:\nOriginal tree: {}\nTransitions: {}".format(tree_idx, name, idx, sequence[idx], flattentrees[tree_idx], sequence))
+
+    # replay all of the sequences at once, so that each step is
+    # a single bulk_apply over every tree which is not yet finished
+    num_steps = max((len(sequence) for sequence in sequences), default=0)
+    for step_idx in range(num_steps):
+        active = [tree_idx for tree_idx, sequence in enumerate(sequences) if step_idx < len(sequence)]
+        try:
+            new_states = bulk_apply_beam([states[tree_idx] for tree_idx in active],
+                                         [sequences[tree_idx][step_idx] for tree_idx in active],
+                                         model, fail=True)
+        except ValueError as e:
+            # the batch error does not say which tree failed, so
+            # replay this step one tree at a time to find it
+            for tree_idx in active:
+                try:
+                    bulk_apply_beam([states[tree_idx]], [sequences[tree_idx][step_idx]], model, fail=True)
+                except ValueError:
+                    raise RuntimeError("Tree {} of {} failed: transition {}:{} could not be applied\nOriginal tree: {}\nTransitions: {}".format(tree_idx, name, step_idx, sequences[tree_idx][step_idx], flattentrees[tree_idx], sequences[tree_idx])) from e
+            raise
+        for tree_idx, state in zip(active, new_states):
+            states[tree_idx] = state
+
+    for tree_idx, (tree, state, sequence) in enumerate(zip(trees, states, sequences)):
+        # created_arcs holds word_queue positions, which count from 1 with ROOT as 0
+        heads = [None] * state.sentence_length
+        for arc in state.created_arcs.flattened[1:]:
+            head, dependent = arc.value
+            heads[dependent - 1] = head
+        gold_heads = [token['head'] for token in tree if len(token['id']) == 1]
+        if not state.finished(model) or heads != gold_heads:
+            raise RuntimeError("Tree {} of {} failed: transition sequence did not match for a tree!\nOriginal tree: {}\nTransitions: {}\nGold heads: {}\nResult heads: {}".format(tree_idx, name, flattentrees[tree_idx], sequence, gold_heads, heads))
 
 def check_constituents(train_constituents, trees, treebank_name, fail=True):
     """
@@ -381,13 +404,9 @@ def remove_singleton_trees(trees):
     return new_trees
 
 def ud_to_flattentree(UD_tree, root_labels = 'TOP'):
-    print("print UD_tree")
-    print(UD_tree)
-    branches = [Tree(token["upos"], Tree(token["text"])) for token in UD_tree]
-    newtree = Tree(root_labels, branches)
-    print("print newtree")
-    print(newtree)
-    return newtree
+    # MWT tokens have a range as their id and are not words of the tree
+    branches = [Tree(token["upos"], Tree(token["text"])) for token in UD_tree if len(token["id"]) == 1]
+    return Tree(root_labels, branches)
 
 def ud_to_flatentrees(UD_trees, root_labels = 'TOP'):
     return [ud_to_flattentree(ud_tree, root_labels) for ud_tree in UD_trees]
\ No newline at end of file
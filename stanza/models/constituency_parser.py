@@ -612,6 +612,7 @@ def build_argparse():
                         help='Transition scheme to use.  {}'.format(", ".join(x.name for x in TransitionScheme)))
 
     parser.add_argument('--reversed', default=False, action='store_true', help='Do the transition sequence reversed')
+    parser.add_argument('--oracle_workers', default=1, type=int, help='Processes to use when building the transition sequences.  Only used if numba is not installed')
 
     # combining dummy and open node embeddings might be a slight improvement
     # for example, after 550 iterations, one experiment had
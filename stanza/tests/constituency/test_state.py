@@ -0,0 +1,54 @@
+import pytest
+
+from stanza.models.constituency.base_model import SimpleModel
+from stanza.models.constituency.parse_transitions import SHIFT
+
+from stanza.tests import *
+
+pytestmark = [pytest.mark.pipeline, pytest.mark.travis]
+
+def build_state():
+    model = SimpleModel()
+    states = model.initial_state_from_words([[("Unban", "VB"), ("Mox", "NNP")]])
+    return model, states[0]
+
+def test_initial_state():
+    model, state = build_state()
+    assert state.num_stacks == 1
+    assert not state.empty_word_queue()
+    assert state.empty_stacks
+    assert not state.finished(model)
+
+def test_replace():
+    """
+    _replace should copy the other fields and recompute the cached fields
+    """
+    model, state = build_state()
+    new_state = state._replace(word_position=2, stacks=(0, 1, 2))
+    assert new_state is not state
+    assert new_state.word_queue is state.word_queue
+    assert new_state.sentence_length == state.sentence_length
+    assert new_state.word_position == 2
+    assert new_state.num_stacks == 3
+    assert new_state.empty_word_queue()
+    assert not new_state.empty_stacks
+
+    # the original State is unchanged
+    assert state.word_position == 0
+    assert state.num_stacks == 1
+    assert not state.empty_word_queue()
+
+    finished = new_state._replace(stacks=(0,))
+    assert finished.finished(model)
+
+def test_apply_updates_cache():
+    """
+    A State built by a transition should have the cached fields of its own stack and buffer
+    """
+    model, state = build_state()
+    state = model.bulk_apply([state], [SHIFT])[0]
+    assert state.num_stacks == 2
+    assert not state.empty_word_queue()
+    state = model.bulk_apply([state], [SHIFT])[0]
+    assert state.num_stacks == 3
+    assert state.empty_word_queue()
@@ -1,9 +1,11 @@
 import pytest
+import numpy as np
 from stanza.models.constituency import parse_transitions
 from stanza.models.constituency import transition_sequence
 from stanza.models.constituency import tree_reader
 from stanza.models.constituency.base_model import SimpleModel, UNARY_LIMIT
 from stanza.models.constituency.parse_transitions import *
+from stanza.utils.conll import CoNLL
 
 from stanza.tests import *
 from stanza.tests.constituency.test_parse_tree import CHINESE_LONG_LIST_TREE
@@ -154,3 +156,168 @@ def test_chinese_tree_reversed():
         # turn off reverse - it should fail to rebuild the tree
         redone = reconstruct_tree(trees[0], transitions[0], transition_scheme=TransitionScheme.IN_ORDER, unary_limit=6)
         assert redone == trees[0]
+
+UD_MWT_TEXT = """
+1-2	ab	_	_	_	_	_	_	_	_
+1	a	a	X	_	_	0	root	_	_
+2	b	b	X	_	_	1	dep	_	_
+3	c	c	X	_	_	2	dep	_	_
+""".lstrip()
+
+def test_ud_oracle_skips_mwt():
+    """
+    Multi-word tokens have no head and should not be part of the oracle, and the tokens should not be changed
+    """
+    sentence = CoNLL.conll2dict(input_str=UD_MWT_TEXT)[0][0]
+    expected = [SHIFT, SHIFT, SHIFT, LEFTARC, LEFTARC, LEFTARC]
+    assert transition_sequence.build_sequence(sentence) == expected
+    assert [token['id'] for token in sentence] == [(1, 2), (1,), (2,), (3,)]
+    # building it again from the same tokens gives the same answer
+    assert transition_sequence.build_treebank([sentence, sentence]) == [expected, expected]
+
+def test_oracle_heads():
+    """
+    Test the integer oracle directly on a list of heads, including a non-projective tree
+    """
+    # 1 <- 2 -> 3, with 2 attached to ROOT
+    codes = transition_sequence.oracle([-1, 2, 0, 2])
+    assert codes.dtype == np.int8
+    assert [NULLARY_TRANSITIONS[code] for code in codes] == [SHIFT, SHIFT, RIGHTARC, SHIFT, LEFTARC, LEFTARC]
+
+    assert len(transition_sequence.oracle([-1])) == 0
+
+    # the arcs 1 -> 3 and 2 -> 4 cross
+    with pytest.raises(ValueError):
+        transition_sequence.oracle([-1, 3, 0, 2, 1])
+
+def test_treebank_transitions():
+    """
+    treebank_transitions should find the same transitions as all_transitions, no matter how the trees are chunked
+    """
+    trees = [[{'id': (1,), 'head': 0}],
+             [{'id': (1,), 'head': 2}, {'id': (2,), 'head': 0}],
+             [{'id': (1,), 'head': 0}, {'id': (2,), 'head': 1}]]
+    expected = transition_sequence.all_transitions(transition_sequence.build_treebank(trees))
+    assert expected == [SHIFT, LEFTARC, RIGHTARC]
+    assert transition_sequence.treebank_transitions(trees) == expected
+    assert transition_sequence.treebank_transitions(trees, chunk_size=1) == expected
+    assert transition_sequence.treebank_transitions(trees[:1], chunk_size=1) == [SHIFT, LEFTARC]
+    assert transition_sequence.treebank_transitions([]) == []
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_build_treebank_nonprojective(monkeypatch, workers):
+    """
+    The batched oracle and the worker processes should report the same tree for a non-projective tree
+    """
+    # force the process pool even if numba is installed
+    monkeypatch.setattr(transition_sequence, "numba", None)
+    monkeypatch.setattr(transition_sequence, "MIN_TREES_FOR_WORKERS", 1)
+    good = [{'id': (1,), 'head': 2}, {'id': (2,), 'head': 0}]
+    bad = [{'id': (1,), 'head': 3}, {'id': (2,), 'head': 0}, {'id': (3,), 'head': 2}, {'id': (4,), 'head': 1}]
+    with pytest.raises(ValueError, match="in tree 2"):
+        transition_sequence.build_treebank([good, good, bad], workers=workers)
+    assert transition_sequence.build_treebank([good, good], workers=workers) == [[SHIFT, SHIFT, RIGHTARC, LEFTARC]] * 2
+
+UD_DOG_TEXT = """
+1	The	the	DET	_	_	2	det	_	_
+2	dog	dog	NOUN	_	_	3	nsubj	_	_
+3	barks	bark	VERB	_	_	0	root	_	_
+4	loudly	loudly	ADV	_	_	3	advmod	_	_
+""".lstrip()
+
+def replay_sequence(sentence, sequence):
+    """
+    Apply the sequence to a State built from the sentence, checking that each transition is legal
+    """
+    model = SimpleModel()
+    states = model.initial_state_from_words([[(token['text'], token['upos']) for token in sentence]])
+    for transition in sequence:
+        assert transition.is_legal(states[0], model)
+        states = model.bulk_apply(states, [transition], fail=True)
+    return states[0]
+
+def word_text(word):
+    """
+    The text of a word in a SimpleModel word queue, or None for the ROOT sentinel
+    """
+    return None if word is None else word.children[0].label
+
+def test_replay_oracle():
+    """
+    The oracle's sequence replayed through SimpleModel should build exactly the gold arcs
+    """
+    sentence = CoNLL.conll2dict(input_str=UD_DOG_TEXT)[0][0]
+    state = replay_sequence(sentence, transition_sequence.build_sequence(sentence))
+    assert state.finished(None)
+    assert state.stacks == (0,)
+
+    arcs = [(word_text(head), word_text(dependent)) for head, dependent in state.all_created_arcs(None)]
+    gold = [(sentence[token['head'] - 1]['text'] if token['head'] > 0 else None, token['text']) for token in sentence]
+    assert sorted(arcs, key=str) == sorted(gold, key=str)
+
+def test_all_created_arcs():
+    """
+    The arcs come back in the order they were made, with ROOT as the start sentinel
+    """
+    sentence = CoNLL.conll2dict(input_str=UD_DOG_TEXT)[0][0]
+    state = replay_sequence(sentence, [SHIFT, SHIFT, RIGHTARC, SHIFT, RIGHTARC, SHIFT, LEFTARC, LEFTARC])
+    assert [arc.value for arc in state.created_arcs.flattened[1:]] == [(2, 1), (3, 2), (3, 4), (0, 3)]
+
+    arcs = [(word_text(head), word_text(dependent)) for head, dependent in state.all_created_arcs(None)]
+    assert arcs == [("dog", "The"), ("barks", "dog"), ("barks", "loudly"), (None, "barks")]
+
+def test_first_illegal_transition():
+    """
+    The integer kernel starts with ROOT on the stack, same as the States, so it accepts the oracle's sequences
+    """
+    sentence = CoNLL.conll2dict(input_str=UD_DOG_TEXT)[0][0]
+    sequence = transition_sequence.build_sequence(sentence)
+    assert first_illegal_transition(sequence, len(sentence)) == -1
+
+    for sentence in CoNLL.conll2dict(input_str=UD_MWT_TEXT)[0]:
+        sequence = transition_sequence.build_sequence(sentence)
+        num_words = sum(1 for token in sentence if len(token['id']) == 1)
+        assert first_illegal_transition(sequence, num_words) == -1
+
+    assert first_illegal_transition([SHIFT, LEFTARC], 1) == -1
+    # ROOT cannot be the dependent of a right arc
+    assert first_illegal_transition([SHIFT, RIGHTARC], 1) == 1
+    assert first_illegal_transition([LEFTARC], 1) == 0
+    assert first_illegal_transition([SHIFT, SHIFT], 1) == 1
+
+def legality_states():
+    """
+    States with empty and non-empty buffers and 0 through 4 items on the stack
+    """
+    state = SimpleModel().initial_state_from_words([[("dog", "NOUN")]])[0]
+    return [state._replace(word_position=word_position, stacks=tuple(range(num_stacks)))
+            for word_position in (0, 1)
+            for num_stacks in range(5)]
+
+def test_legal_mask():
+    model = SimpleModel()
+    states = legality_states()
+    transitions = NULLARY_TRANSITIONS
+    mask = legal_mask(states, transitions, model)
+    expected = [[transition.is_legal(state, model) for transition in transitions] for state in states]
+    assert mask.tolist() == expected
+
+class AlwaysIllegal(Transition):
+    """
+    A transition with no OPCODE, so legal_mask asks it directly
+    """
+    def update_state(self, state, model):
+        raise AssertionError("Should not be applied")
+
+    def is_legal(self, state, model):
+        return False
+
+    def short_name(self):
+        return "Illegal"
+
+def test_legal_mask_fallback():
+    model = SimpleModel()
+    states = legality_states()
+    mask = legal_mask(states, (SHIFT, AlwaysIllegal()), model)
+    assert mask[:, 0].tolist() == [SHIFT.is_legal(state, model) for state in states]
+    assert not mask[:, 1].any()
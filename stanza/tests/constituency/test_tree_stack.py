@@ -48,3 +48,17 @@ def test_long_len():
     for i in range(1, 40):
         stack = stack.push(i)
     assert len(stack) == 40
+
+def test_flattened():
+    stack = TreeStack(value=5, parent=None, length=1)
+    stack = stack.push(3)
+    branch = stack.push(1)
+
+    assert [x.value for x in branch.flattened] == [5, 3, 1]
+    assert branch.flattened[-1] is branch
+
+    # the other branch reuses the memoized prefix of the shared parent
+    stack.flattened
+    other = stack.push(2).push(4)
+    assert [x.value for x in other.flattened] == [5, 3, 2, 4]
+    assert [x.value for x in branch.flattened] == [5, 3, 1]
@@ -1,8 +1,11 @@
 import pytest
 
 from stanza import Pipeline
+from stanza.models.constituency import transition_sequence
 from stanza.models.constituency import tree_reader
 from stanza.models.constituency import utils
+from stanza.models.constituency.parse_transitions import TransitionScheme
+from stanza.utils.conll import CoNLL
 
 from stanza.tests import *
 
@@ -66,3 +69,41 @@ def test_replace_tags():
         new_tags = ["A", "B", "C", "D"]
         new_tree = trees[0].replace_tags(new_tags)
 
+UD_VERIFY_TEXT = """
+1	The	the	DET	_	_	2	det	_	_
+2	dog	dog	NOUN	_	_	3	nsubj	_	_
+3	barks	bark	VERB	_	_	0	root	_	_
+4	loudly	loudly	ADV	_	_	3	advmod	_	_
+
+1-2	ab	_	_	_	_	_	_	_	_
+1	a	a	X	_	_	0	root	_	_
+2	b	b	X	_	_	1	dep	_	_
+3	c	c	X	_	_	1	dep	_	_
+4	d	d	X	_	_	3	dep	_	_
+""".lstrip()
+
+def verify(trees, sequences):
+    utils.verify_transitions(trees, sequences, TransitionScheme.IN_ORDER, 3, False, "test", ("TOP",))
+
+def test_verify_transitions():
+    """
+    The sequences built by the oracle should rebuild the same arcs, including for a sentence with an MWT
+    """
+    trees = CoNLL.conll2dict(input_str=UD_VERIFY_TEXT)
+    sequences, _ = transition_sequence.convert_trees_to_sequences(trees, "test", TransitionScheme.IN_ORDER)
+    verify(trees, sequences)
+
+def test_verify_transitions_failure():
+    """
+    A legal sequence which builds the wrong arcs should fail, naming the tree which failed
+    """
+    trees = CoNLL.conll2dict(input_str=UD_VERIFY_TEXT)
+    sequences, _ = transition_sequence.convert_trees_to_sequences(trees, "test", TransitionScheme.IN_ORDER)
+    # both trees have four words, so each sequence is legal for the other tree
+    sequences = [sequences[0], sequences[0]]
+    with pytest.raises(RuntimeError, match="Tree 1 of test failed"):
+        verify(trees, sequences)
+
+    sequences = [sequences[0], sequences[0][1:]]
+    with pytest.raises(RuntimeError, match="Tree 1 of test failed: transition 1"):
+        verify(trees, sequences)
@@ -12,13 +12,14 @@ def main():
     parser.add_argument('--transition_scheme', default=TransitionScheme.IN_ORDER, type=lambda x: TransitionScheme[x.upper()],
                         help='Transition scheme to use.  {}'.format(", ".join(x.name for x in TransitionScheme)))
     parser.add_argument('--reversed', default=False, action='store_true', help='Do the transition sequence reversed')
+    parser.add_argument('--oracle_workers', default=1, type=int, help='Processes to use when building the transition sequences.  Only used if numba is not installed')
     parser.add_argument('--iterations', default=30, type=int, help='How many times to iterate, such as if doing a cProfile')
     args = parser.parse_args()
     args = vars(args)
 
     train_trees = tree_reader.read_treebank(args['train_file'])
     unary_limit = max(t.count_unary_depth() for t in train_trees) + 1
-    train_sequences, train_transitions = transition_sequence.convert_trees_to_sequences(train_trees, "training", args['transition_scheme'], args['reversed'])
+    train_sequences, train_transitions = transition_sequence.convert_trees_to_sequences(train_trees, "training", args['transition_scheme'], args['reversed'], args['oracle_workers'])
     root_labels = Tree.get_root_labels(train_trees)
     for i in range(args['iterations']):
         verify_transitions(train_trees, train_sequences, args['transition_scheme'], unary_limit, args['reversed'], "train", root_labels)